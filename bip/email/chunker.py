@@ -1,20 +1,28 @@
 import logging
 
-from bip.email.gmail import get_message_text_from_payload, get_header_value, \
-    get_last_threads, gmail_api_client
+from bip.email.gmail import get_message_text_from_payload, \
+    get_last_threads, gmail_api_client, credentials
 from bip.config import test_email
 from bip import utils
 
 
-def _create_chunk_metadata(chunk, message, chunk_index):
+def _headers_dict(headers):
+    """Index the message headers by name, keeping the first value of repeated
+    headers as `get_header_value` does."""
+    return {h['name']: h['value'] for h in reversed(headers)}
+
+
+def _create_chunk_metadata(chunk, message, headers, chunk_index, n_tokens):
     """Create metadata for the chunk, with the id of the thread, id of the
-    message, date of the message, and chunk position
+    message, date of the message, chunk position and chunk size in tokens
 
     :param chunk: the chunk
     :param message: the message
+    :param headers: the message headers, as given by `_headers_dict`
+    :param n_tokens: the number of tokens of the chunk, without enrichment
     :return: the metadata
     """
-    subject = get_header_value(message['payload']['headers'], 'Subject')
+    subject = headers.get('Subject')
     date = message['internalDate']
     metadata = {
         'subject': subject if subject else "No subject",
@@ -24,6 +32,7 @@ def _create_chunk_metadata(chunk, message, chunk_index):
         'thread_id': message['threadId'],
         'source': subject if subject else "No subject",
         'text': chunk,
+        'n_tokens': n_tokens,
     }
     return metadata
 
@@ -32,20 +41,31 @@ CHUNK_HEADER_SEPARATOR = "\n--DEBUT EXTRAIT--\n"
 CHUNK_FOOTER_SEPARATOR = "\n--FIN EXTRAIT--\n"
 
 
-def _enrich_chunk(chunk, message, index, total):
+def _extract_headers(message, headers):
+    """Get subject, sender, main recipients and formatted date of the message,
+    to be computed once per message rather than once per chunk.
+
+    :param message: the message
+    :param headers: the message headers, as given by `_headers_dict`
+    :return: the subject, sender, recipients and formatted date
+    """
+    subject = headers.get('Subject')
+    sender = headers.get('From')
+    recipients = headers.get('To')
+    date = message['internalDate']
+    formatted_date = utils.french_date_from_timestamp(int(date) / 1000)
+    return subject, sender, recipients, formatted_date
+
+
+def _enrich_chunk(chunk, header_bundle, index, total):
     """Add subject, sender, main recipients and date as header text to
     the chunk.
 
     :param chunk: the chunk to enrich
-    :param message: the message to get the headers from
+    :param header_bundle: the message headers, as given by `_extract_headers`
     :return: the enriched chunk
     """
-    # Get relevant data from headers
-    subject = get_header_value(message['payload']['headers'], 'Subject')
-    sender = get_header_value(message['payload']['headers'], 'From')
-    date = message['internalDate']
-    formatted_date = utils.french_date_from_timestamp(int(date) / 1000)
-    recipients = get_header_value(message['payload']['headers'], 'To')
+    subject, sender, recipients, formatted_date = header_bundle
 
     # Enrich chunk
     enriched_chunk = (f"Sujet: {subject}{CHUNK_HEADER_SEPARATOR}"
@@ -55,24 +75,32 @@ def _enrich_chunk(chunk, message, index, total):
     return enriched_chunk
 
 
-def _create_chunks(message, chunk_size):
+CHUNK_OVERLAP_RATIO = 8
+
+
+def _chunk_step(chunk_size):
+    """Get the step between two consecutive chunks, so that chunks overlap on
+    1/CHUNK_OVERLAP_RATIO of their size."""
+    return chunk_size - chunk_size // CHUNK_OVERLAP_RATIO
+
+
+def _create_chunks(message, chunk_size, message_tokens=None):
     """Create chunks from the message.
 
     :param message: the message to chunk
     :param chunk_size: the maximum size of the chunks in tokens
-    :return: the chunks
+    :param message_tokens: the tokens of the message text, if already computed
+    :return: the chunks, as (chunk text, number of tokens) tuples
     """
-    message_text = get_message_text_from_payload(message['payload'])
-    message_tokens = utils.tokenize(message_text)
-    chunks = []
-    chunk_overlap = int(chunk_size / 8)
-    chunk_step = chunk_size - chunk_overlap
-    for i in range(0, len(message_tokens), chunk_step):
-        chunks.append(utils.detokenize(message_tokens[i:i + chunk_size]))
-    return chunks
+    if message_tokens is None:
+        message_text = get_message_text_from_payload(message['payload'])
+        message_tokens = utils.tokenize(message_text)
+    windows = [message_tokens[i:i + chunk_size]
+               for i in range(0, len(message_tokens), _chunk_step(chunk_size))]
+    return [(utils.detokenize(w), len(w)) for w in windows]
 
 
-def cut_message(message, chunk_size=256):
+def cut_message(message, chunk_size=256, message_tokens=None):
     """
     Cut the message in chunks, enrich them, create the metadata for each
     chunk and return the outcome
@@ -81,25 +109,26 @@ def cut_message(message, chunk_size=256):
     https://developers.google.com/gmail/api/v1/reference/users/messages
 
     :param message: the message to cut
+    :param message_tokens: the tokens of the message text, if already computed
     :return: the enriched chunks and the chunks metadatas
     """
     # compute chunks
-    chunks = _create_chunks(message, chunk_size=chunk_size)
+    chunks = _create_chunks(message, chunk_size=chunk_size,
+                            message_tokens=message_tokens)
     if not chunks:
         logging.warning("Empty message")
         return [], []
 
-    # compute enriched chunks
-    def enrich_chunk(c, i):
-        return _enrich_chunk(c, message, i, len(chunks))
-    enriched_chunks = list(map(enrich_chunk, chunks, range(len(chunks))))
+    headers = _headers_dict(message['payload']['headers'])
+    header_bundle = _extract_headers(message, headers)
 
-    # compute chunks metadatas
-    def chunk_metadata(chunk, index):
-        return _create_chunk_metadata(chunk, message, index)
-    chunks_metadatas = list(map(chunk_metadata,
-                                enriched_chunks,
-                                range(len(chunks))))
+    # compute enriched chunks and their metadatas
+    enriched_chunks, chunks_metadatas = [], []
+    for i, (chunk, n_tokens) in enumerate(chunks):
+        enriched_chunk = _enrich_chunk(chunk, header_bundle, i, len(chunks))
+        enriched_chunks.append(enriched_chunk)
+        chunks_metadatas.append(_create_chunk_metadata(
+            enriched_chunk, message, headers, i, n_tokens))
 
     return enriched_chunks, chunks_metadatas
 
@@ -137,13 +166,13 @@ def glue_chunks(enriched_chunks,
     """
     # get the header text from a chunk
     # and remove the "Message part X of Y" from the header
-    header_text = enriched_chunks[0].split(CHUNK_HEADER_SEPARATOR)[0]
-    footer_text = enriched_chunks[0].split(CHUNK_FOOTER_SEPARATOR)[1]
+    header_text = enriched_chunks[0].partition(CHUNK_HEADER_SEPARATOR)[0]
+    footer_text = enriched_chunks[0].partition(CHUNK_FOOTER_SEPARATOR)[2]
 
     chunk_indices = [m['chunk_index'] for m in chumk_metadatas]
 
     # remove the header & footer from each chunk
-    cleaned_chunks = [chunk.split(CHUNK_HEADER_SEPARATOR)[1].split(
+    cleaned_chunks = [chunk.partition(CHUNK_HEADER_SEPARATOR)[2].partition(
         CHUNK_FOOTER_SEPARATOR)[0]
         for chunk in enriched_chunks]
 
@@ -155,15 +184,20 @@ def glue_chunks(enriched_chunks,
                         + utils.count_tokens(footer_text))
 
     selected_chunks = []
-    for chunk in cleaned_chunks:
-        if total_tokens + utils.count_tokens(chunk) > max_tokens:
+    for chunk, metadata in zip(cleaned_chunks, chumk_metadatas):
+        # chunks stored before token counts were added to the metadata
+        # have to be counted
+        chunk_tokens = (metadata['n_tokens'] if 'n_tokens' in metadata
+                        else utils.count_tokens(chunk))
+        if total_tokens + chunk_tokens > max_tokens:
             break
         selected_chunks.append(chunk)
-        total_tokens += utils.count_tokens(chunk)
+        total_tokens += chunk_tokens
 
     # order remaining chunks according to their index
-    selected_chunks = [chunk for _, chunk in sorted(zip(chunk_indices,
-                                                        selected_chunks))]
+    selected_order = sorted(range(len(selected_chunks)),
+                            key=lambda i: chunk_indices[i])
+    selected_chunks = [selected_chunks[i] for i in selected_order]
     # join the texts with the delimiter
     header_text = (
         header_text + CHUNK_HEADER_SEPARATOR) if keep_headfooter else ""
@@ -187,7 +221,7 @@ def test_chunks():
     client = gmail_api_client(test_email)
 
     # Get last threads from gmail, store their content in a chroma database
-    for thread in get_last_threads(client, 3):
+    for thread in get_last_threads(client, credentials(test_email), 3):
         enriched_chunks, chunks_metadatas = cut_message(thread['messages'][0])
         print("Enriched chunks:" + str(len(enriched_chunks)))
         print("Chunks metadatas:" + str(len(chunks_metadatas)))
@@ -2,20 +2,48 @@
 import datetime
 import json
 import re
+import threading
+import time
 import html2text
 import base64
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 
 from googleapiclient.errors import HttpError
 from googleapiclient.discovery import build
+from googleapiclient.http import build_http
 
 from bip import utils
-from bip.config import test_email
+from bip.config import test_email, logger
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
+# Maximum number of requests in a single batch HTTP call, as recommended by
+# https://developers.google.com/gmail/api/guides/batch
+BATCH_GET_SIZE = 50
+# Number of times messages that failed to be fetched in a batch are retried
+BATCH_GET_RETRIES = 5
+# Fields of the message and thread resources actually used, to request only
+# those. See https://developers.google.com/gmail/api/guides/performance
+MESSAGE_FIELDS = 'id,threadId,internalDate,snippet,payload'
+THREAD_FIELDS = f'id,messages({MESSAGE_FIELDS})'
+# Number of concurrent requests to the gmail API, well within per-user quotas
+MAX_WORKERS = 10
+
+_local = threading.local()
+# Credentials by user email, loaded from the secrets once per process
+_credentials = {}
+
+# Patterns used to clean message texts
+_URL_RE = re.compile(r'http\S+')
+_RUN1_RE = re.compile(r'(.)\1{3,}')
+_RUN2_RE = re.compile(r'(..)\1{3,}')
+# Payload parts with these mime types are attachments, not message text
+_NON_TEXT_MIME_TYPES = ('image/', 'application/', 'audio/', 'video/')
 
 
 def credentials(user_email):
@@ -25,12 +53,14 @@ def credentials(user_email):
     # the gmail json token stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
     # time.
-    try:
-        token = utils.get_secret(f"{user_email}-gmail-token")
-        creds = Credentials.from_authorized_user_info(
-            json.loads(token), SCOPES)
-    except FileNotFoundError:
-        creds = None
+    creds = _credentials.get(user_email)
+    if creds is None:
+        try:
+            token = utils.get_secret(f"{user_email}-gmail-token")
+            creds = Credentials.from_authorized_user_info(
+                json.loads(token), SCOPES)
+        except FileNotFoundError:
+            creds = None
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
@@ -42,12 +72,35 @@ def credentials(user_email):
             creds = flow.run_local_server(port=0)
         # Save the credentials for the next run
         utils.set_secret(f"{user_email}-gmail-token", creds.to_json())
+    _credentials[user_email] = creds
     return creds
 
 
+@lru_cache(maxsize=8)
 def gmail_api_client(user_email):
-    """Get the gmail API client."""
-    return build('gmail', 'v1', credentials=credentials(user_email))
+    """Get the gmail API client, built once per user email.
+
+    The client refreshes its credentials by itself when they expire, and uses
+    the discovery document shipped with the library rather than fetching it.
+    """
+    return build('gmail', 'v1', credentials=credentials(user_email),
+                 static_discovery=True)
+
+
+def _thread_http(creds):
+    """Get an authorized http object dedicated to the current thread.
+
+    The http object shared by an API client is not thread-safe, so requests
+    executed from worker threads must use their own. It is built like the
+    client's one, with googleapiclient's default timeout and redirect
+    handling.
+
+    :param creds: the credentials of the gmail API client
+    """
+    http = getattr(_local, 'http', None)
+    if http is None or http.credentials is not creds:
+        _local.http = AuthorizedHttp(creds, http=build_http())
+    return _local.http
 
 
 def get_header_value(headers, name):
@@ -62,32 +115,43 @@ def _clean(text):
     """Clean the text of a message.
     """
     # Turn any URL into a special token
-    text = re.sub(r'http\S+', '<URL>', text)
+    text = _URL_RE.sub('<URL>', text)
     # Any character repeated more than 3 times is replaced by 3 of them
-    text = re.sub(r'(.)\1{3,}', r'\1\1\1', text)
+    text = _RUN1_RE.sub(r'\1\1\1', text)
     # Any two characters repeated more than 3 times is replaced by 2 of them
-    text = re.sub(r'(..)\1{3,}', r'\1\1', text)
+    text = _RUN2_RE.sub(r'\1\1', text)
     return text
 
 
+def _html_converter():
+    """Create a html to text converter. Converters keep parser state between
+    texts, e.g. after an unclosed <style> tag, so one is created per text."""
+    converter = html2text.HTML2Text()
+    converter.ignore_links = True
+    converter.ignore_images = True
+    return converter
+
+
 def get_message_text_from_payload(message_part):
     """Get the message text from the message payload."""
-    body = message_part['body']
-    result = u''
-    if 'data' in body:
-        raw_data = base64.urlsafe_b64decode(body['data']).decode('utf-8')
-        if message_part['mimeType'] == 'text/html':
-            h = html2text.HTML2Text()
-            h.ignore_links = True
-            h.ignore_images = True
-            result = h.handle(raw_data)
-        elif message_part['mimeType'] == 'text/plain':
-            result = raw_data
-    result = _clean(result)
-    parts = message_part.get('parts', [])
-    for part in parts:
-        result += get_message_text_from_payload(part)
-    return result
+    texts = []
+    # depth-first traversal of the parts, in the order they appear
+    parts = [message_part]
+    while parts:
+        part = parts.pop()
+        mime_type = part['mimeType']
+        # attachments never contribute text, skip them and their subparts
+        if mime_type.startswith(_NON_TEXT_MIME_TYPES):
+            continue
+        body = part['body']
+        # only decode non-empty text bodies
+        if body.get('data') and mime_type in ('text/html', 'text/plain'):
+            raw_data = base64.urlsafe_b64decode(body['data']).decode('utf-8')
+            if mime_type == 'text/html':
+                raw_data = _html_converter().handle(raw_data)
+            texts.append(raw_data)
+        parts.extend(reversed(part.get('parts', [])))
+    return _clean(''.join(texts))
 
 
 def _display_thread(thread):
@@ -102,24 +166,27 @@ def _display_thread(thread):
         print('\nSender: %s\nBody: %s' % (sender, body))
 
 
-def get_last_threads(gmail_api_client, number_of_threads):
+def get_last_threads(gmail_api_client, creds, number_of_threads):
     """Get the last threads from Gmail.
 
     Doc: https://developers.google.com/gmail/api/v1/reference/users/threads/
+    :param gmail_api_client: the gmail API client
+    :param creds: the credentials of the gmail API client
+    :param number_of_threads: the number of threads to get
     """
     try:
         response = (gmail_api_client.users().threads()
                     .list(userId='me', maxResults=number_of_threads)
                     .execute())
         threads = response['threads']
-        result = []
-        for thread in threads:
-            thread_id = thread['id']
-            thread = (gmail_api_client.users().threads()
-                      .get(userId='me', id=thread_id)
-                      .execute())
-            result.append(thread)
-        return result
+
+        def get_thread(thread):
+            return (gmail_api_client.users().threads()
+                    .get(userId='me', id=thread['id'], fields=THREAD_FIELDS)
+                    .execute(http=_thread_http(creds)))
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            return list(executor.map(get_thread, threads))
     except HttpError as error:
         print('An error occurred: %s' % error)
 
@@ -127,10 +194,64 @@ def get_last_threads(gmail_api_client, number_of_threads):
 def _get_message(gmail_client, message_head):
     """Get message from a message head returned by the gmail 'list' API call"""
     return (gmail_client.users().messages()
-            .get(userId='me', id=message_head['id'])
+            .get(userId='me', id=message_head['id'], fields=MESSAGE_FIELDS)
             .execute())
 
 
+def _is_transient_error(error):
+    """Whether a gmail API error is worth retrying: rate limiting or server
+    errors"""
+    status = error.resp.status
+    return status == 429 or status >= 500
+
+
+def _batch_get_messages(gmail_client, message_heads):
+    """Get messages from message heads returned by the gmail 'list' API call,
+    using batch HTTP requests to fetch up to BATCH_GET_SIZE messages per round
+    trip.
+
+    Messages that could not be retrieved because of a transient error, e.g.
+    rate limiting, are fetched again in new batches with exponential backoff,
+    up to BATCH_GET_RETRIES times; if some still fail, the last error is
+    raised. Messages not found, e.g. deleted since they were listed, are
+    skipped, and any other error is raised right away. Messages are returned
+    in the order of the message heads.
+    """
+    messages, errors = {}, {}
+
+    def store_message(request_id, response, exception):
+        if exception is None:
+            messages[request_id] = response
+        elif exception.resp.status == 404:
+            logger.warning(f"Message {request_id} not found, skipping it")
+        else:
+            errors[request_id] = exception
+
+    message_ids = [h['id'] for h in message_heads]
+    for attempt in range(BATCH_GET_RETRIES + 1):
+        if attempt:
+            logger.warning(f"Could not get {len(message_ids)} messages, "
+                           f"retrying (attempt {attempt})")
+            time.sleep(2 ** attempt)
+        errors.clear()
+        for i in range(0, len(message_ids), BATCH_GET_SIZE):
+            batch = gmail_client.new_batch_http_request(callback=store_message)
+            for message_id in message_ids[i:i + BATCH_GET_SIZE]:
+                batch.add(gmail_client.users().messages()
+                          .get(userId='me', id=message_id,
+                               fields=MESSAGE_FIELDS),
+                          request_id=message_id)
+            batch.execute()
+        for error in errors.values():
+            if not _is_transient_error(error):
+                raise error
+        message_ids = [i for i in message_ids if i in errors]
+        if not message_ids:
+            return [messages[h['id']] for h in message_heads
+                    if h['id'] in messages]
+    raise errors[message_ids[0]]
+
+
 def get_last_emails(gmail_client, last_update_date):
     """Get the last emails from Gmail
 
@@ -146,8 +267,7 @@ def get_last_emails(gmail_client, last_update_date):
         message_heads = response['messages']
         if not message_heads:
             return []
-        return list(
-            map(lambda x: _get_message(gmail_client, x), message_heads))
+        return _batch_get_messages(gmail_client, message_heads)
     except HttpError as error:
         print('An error occurred: %s' % error)
 
@@ -155,7 +275,7 @@ def get_last_emails(gmail_client, last_update_date):
 def test_gmail_api():
     client = gmail_api_client(test_email)
     # retrieve the last 3 threads from Gmail
-    last_threads = get_last_threads(client, 3)
+    last_threads = get_last_threads(client, credentials(test_email), 3)
 
     # display the last 3 threads
     for thread in last_threads:
@@ -172,35 +292,46 @@ if __name__ == '__main__':
         print(message['snippet'])
 
 
-def email_batches_by_query(gmail_client, query, batch_size=100):
+def email_batches_by_query(gmail_client, creds, query, batch_size=100):
     """Get emails between two dates and return them in batches via a generator.
 
     :param gmail_client: the gmail API client
+    :param creds: the credentials of the gmail API client
     :param query: the query to use
     :param batch_size: the batch size
+    :return: a generator of non-empty lists of messages
     """
-    # get the first batch of emails
-    response = (gmail_client.users().messages()
-                .list(userId='me', q=query)
-                .execute())
-    while True:
-        message_heads = response['messages']
-        for i in range(0, len(message_heads), batch_size):
-            yield list(map(lambda x: _get_message(gmail_client, x),
-                           message_heads[i:i + batch_size]))
-        if 'nextPageToken' not in response:
-            break
-        response = (gmail_client.users().messages()
-                    .list(userId='me',
-                          q=query,
-                          pageToken=response['nextPageToken'])
-                    .execute())
-
-
-def email_batches_by_dates(gmail_client, start_date, end_date, batch_size=100):
+    def list_messages(page_token=None):
+        return (gmail_client.users().messages()
+                .list(userId='me', q=query, pageToken=page_token)
+                .execute(http=_thread_http(creds)))
+
+    # fetch the next page of message heads while the current one is processed
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        response = executor.submit(list_messages).result()
+        while True:
+            next_response = None
+            if 'nextPageToken' in response:
+                next_response = executor.submit(list_messages,
+                                                response['nextPageToken'])
+            message_heads = response.get('messages', [])
+            for i in range(0, len(message_heads), batch_size):
+                messages = _batch_get_messages(
+                    gmail_client, message_heads[i:i + batch_size])
+                # all messages of a batch may have been deleted since listed
+                if messages:
+                    yield messages
+            if next_response is None:
+                break
+            response = next_response.result()
+
+
+def email_batches_by_dates(gmail_client, creds, start_date, end_date,
+                           batch_size=100):
     """Get emails between two dates and return them in batches via a generator.
 
     :param gmail_client: the gmail API client
+    :param creds: the credentials of the gmail API client
     :param start_date: the start date, inclusive
     :param end_date: the end date, exclusive
     :param batch_size: the batch size
@@ -208,5 +339,6 @@ def email_batches_by_dates(gmail_client, start_date, end_date, batch_size=100):
     start_date = start_date.strftime('%Y/%m/%d')
     end_date = end_date.strftime('%Y/%m/%d')
     return email_batches_by_query(gmail_client,
+                                  creds,
                                   f"after:{start_date} before:{end_date}",
                                   batch_size)
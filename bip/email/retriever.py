@@ -1,14 +1,16 @@
 # This module retrieves emails from a gmail account and stores them in a
 # vector store
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import os.path
 import sys
+import numpy as np
 import openai
 
 import pinecone
 
 from bip.email import gmail, chunker
-from bip.utils import get_secret, embed
+from bip.utils import get_secret, embed, embed_query, tokenize_batch
 from bip.config import test_email, logger, emails_index
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
@@ -16,29 +18,53 @@ openai.api_key = os.getenv("OPENAI_API_KEY")
 
 class Retriever(object):
     UPSERT_BATCH_SIZE = 100
+    EMBED_BATCH_SIZE = 512
+    FETCH_BATCH_SIZE = 100
 
     def __init__(self, user_email):
         self._namespace = user_email
         self._gmail_client = gmail.gmail_api_client(user_email)
+        self._gmail_creds = gmail.credentials(user_email)
         pinecone.init(api_key=get_secret("pinecone"),
                       environment="eu-west1-gcp")
         self._index = pinecone.Index(emails_index)
         logger.info(f"Retriever initialized for {user_email} ")
 
-    def _already_fully_stored(self, email_batch):
-        """Check if the email batch is already fully stored in the index.
+    def _stored_message_ids(self, email_batch):
+        """Get the ids of the messages of the batch that are already stored in
+        the index, i.e. whose first chunk is in the index.
 
-        Since we store the emails in batches,  and assume they are sorted by
-        descending date, we can check if the first and last emails of the batch
-        are already stored. Since the index stores message chunks, not
-        messages, we check for the first chunk of the first and last message,
-        using the chunk_id function
+        The first chunk of a message is upserted after all its other chunks
+        (see `_chunk_groups`), so its presence means the message is complete.
         """
-        first_id = chunker.chunk_id(email_batch[0]['id'], 0)
-        last_id = chunker.chunk_id(email_batch[-1]['id'], 0)
-
-        return (self._index.fetch([first_id], self._namespace)['vectors']
-                and self._index.fetch([last_id], self._namespace)['vectors'])
+        first_chunk_ids = [chunker.chunk_id(m['id'], 0) for m in email_batch]
+        stored_ids = set()
+        for i in range(0, len(first_chunk_ids), self.FETCH_BATCH_SIZE):
+            stored_ids.update(self._index.fetch(
+                first_chunk_ids[i:i + self.FETCH_BATCH_SIZE],
+                self._namespace)['vectors'])
+        return {m['id'] for m, first_chunk_id in zip(email_batch,
+                                                     first_chunk_ids)
+                if first_chunk_id in stored_ids}
+
+    def _messages_to_store(self, email_batch):
+        """Get the messages of the batch that still have to be stored, along
+        with their texts.
+
+        Messages already stored are left out, as well as messages without
+        text: they have no chunk, so they can never be found in the index.
+        """
+        stored_ids = self._stored_message_ids(email_batch)
+        messages, message_texts = [], []
+        for message in email_batch:
+            if message['id'] in stored_ids:
+                continue
+            message_text = gmail.get_message_text_from_payload(
+                message['payload'])
+            if message_text:
+                messages.append(message)
+                message_texts.append(message_text)
+        return messages, message_texts
 
     def _store_chunks(self, chunks):
         for i in range(0, len(chunks), self.UPSERT_BATCH_SIZE):
@@ -48,26 +74,69 @@ class Retriever(object):
             self._index.upsert(vectors=chunks[i:i + self.UPSERT_BATCH_SIZE],
                                namespace=self._namespace)
 
+    def _chunk_groups(self, email_batch, message_texts=None):
+        """Cut messages into chunks, yielding the enriched chunks and their
+        metadatas by groups of EMBED_BATCH_SIZE as messages are cut.
+
+        The texts of the messages are extracted unless given in
+        message_texts."""
+        logger.info("Cutting messages")
+        if message_texts is None:
+            message_texts = [gmail.get_message_text_from_payload(m['payload'])
+                             for m in email_batch]
+        messages_tokens = tokenize_batch(message_texts)
+        enriched_chunks, metadatas = [], []
+        for message, message_tokens in zip(email_batch, messages_tokens):
+            ecs, ms = chunker.cut_message(message,
+                                          message_tokens=message_tokens)
+            # the first chunk goes last, to mark the message as fully stored
+            enriched_chunks += ecs[1:] + ecs[:1]
+            metadatas += ms[1:] + ms[:1]
+            while len(enriched_chunks) >= self.EMBED_BATCH_SIZE:
+                yield (enriched_chunks[:self.EMBED_BATCH_SIZE],
+                       metadatas[:self.EMBED_BATCH_SIZE])
+                del enriched_chunks[:self.EMBED_BATCH_SIZE]
+                del metadatas[:self.EMBED_BATCH_SIZE]
+        if enriched_chunks:
+            yield enriched_chunks, metadatas
+
+    def _iter_chunks(self, email_batch, message_texts=None):
+        """Cut messages into chunks and embed them, yielding the chunk data by
+        groups of EMBED_BATCH_SIZE.
+
+        A group is embedded in a background thread while the previous one is
+        being processed, and only those two groups are held in memory.
+        """
+        def embed_array(texts):
+            # pending vectors are held as a contiguous float32 array rather
+            # than lists of boxed floats
+            return np.asarray(embed(texts), dtype=np.float32)
+
+        def chunk_data(vectors_future, metadatas):
+            vectors = vectors_future.result()
+            # the pinecone client requires vectors as lists
+            return [(chunker.chunk_id(m['message_id'], m['chunk_index']),
+                     vectors[i].tolist(), m)
+                    for i, m in enumerate(metadatas)]
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            previous_group = None
+            chunk_groups = self._chunk_groups(email_batch, message_texts)
+            for enriched_chunks, metadatas in chunk_groups:
+                logger.info(f"Embedding {len(enriched_chunks)} chunks")
+                group = (executor.submit(embed_array, enriched_chunks),
+                         metadatas)
+                if previous_group:
+                    yield chunk_data(*previous_group)
+                previous_group = group
+            if previous_group:
+                yield chunk_data(*previous_group)
+
     def _cut_messages(self, email_batch):
         """Cut messages into chunks and embed them"""
-        enriched_chunks, metadatas, full_chunk_data = [], [], []
-        logger.info("Cutting messages")
-        for i, message in enumerate(email_batch):
-            ecs, ms = chunker.cut_message(message)
-            enriched_chunks += ecs
-            metadatas += ms
-
-        logger.info("Embedding chunks")
-        chunk_vector_batches = [embed(enriched_chunks[i:i + 512])
-                                for i in range(0, len(enriched_chunks), 512)]
-        chunk_vectors = [item
-                         for sublist in chunk_vector_batches
-                         for item in sublist]
-
-        for cv, m in zip(chunk_vectors, metadatas):
-            chunk_id = chunker.chunk_id(m['message_id'], m['chunk_index'])
-            full_chunk_data.append((chunk_id, cv, m))
-        return full_chunk_data
+        return [chunk_data
+                for group in self._iter_chunks(email_batch)
+                for chunk_data in group]
 
     def _get_batch_date(self, email_batch):
         """Get the date of the first message in the batch"""
@@ -75,12 +144,13 @@ class Retriever(object):
         return (datetime.fromtimestamp(first_message_ts)
                 .strftime("%Y-%m-%d %H:%M"))
 
-    def _store_email_batch(self, email_batch):
-        """Store an email batch in the index"""
-        logger.info("Storing new batch starting from date "
-                    + self._get_batch_date(email_batch))
-        chunks = self._cut_messages(email_batch)
-        self._store_chunks(chunks)
+    def _store_email_batch(self, email_batch, message_texts=None):
+        """Store an email batch in the index, using the message texts if
+        already extracted"""
+        logger.info(f"Storing {len(email_batch)} new messages starting from "
+                    "date " + self._get_batch_date(email_batch))
+        for chunks in self._iter_chunks(email_batch, message_texts):
+            self._store_chunks(chunks)
 
     def delete_all_emails(self):
         """Delete all emails from the index"""
@@ -92,11 +162,13 @@ class Retriever(object):
         logger.info("Updating email index with emails "
                     f"between {start_date} and {end_date}")
         batches = gmail.email_batches_by_dates(self._gmail_client,
+                                               self._gmail_creds,
                                                start_date,
                                                end_date)
         for email_batch in batches:
-            if not self._already_fully_stored(email_batch):
-                self._store_email_batch(email_batch)
+            messages, message_texts = self._messages_to_store(email_batch)
+            if messages:
+                self._store_email_batch(messages, message_texts)
             else:
                 logger.info("Email batch starting from date "
                             + self._get_batch_date(email_batch)
@@ -105,7 +177,7 @@ class Retriever(object):
     def query(self, query, **kwargs):
         """Query the index"""
         return self._index.query(
-            vector=embed(query),
+            vector=embed_query(query),
             namespace=self._namespace,
             **kwargs)
 
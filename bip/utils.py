@@ -1,6 +1,7 @@
-from datetime import datetime
-import locale
+from datetime import datetime, timezone
+from functools import lru_cache
 import os.path
+from babel.dates import format_date
 import openai
 import tiktoken
 
@@ -53,19 +54,42 @@ def embed(texts):
     return [x['embedding'] for x in response['data']]
 
 
+@lru_cache(maxsize=2048)
+def _embed_one(text):
+    return tuple(embed(text)[0])
+
+
+def embed_query(text):
+    """Embed a single query text, reusing the embedding of previous identical
+    queries in the process"""
+    return list(_embed_one(text))
+
+
+@lru_cache
+def get_tokenizer(model="text-davinci-003"):
+    """Get the tokenizer for the model, loaded once per process"""
+    return tiktoken.encoding_for_model(model)
+
+
+@lru_cache(maxsize=4096)
 def count_tokens(text, model="text-davinci-003"):
-    return len(tiktoken.encoding_for_model(model).encode(text))
+    return len(get_tokenizer(model).encode(text))
 
 
 def tokenize(text, model="text-davinci-003"):
-    return tiktoken.encoding_for_model(model).encode(text)
+    return get_tokenizer(model).encode(text)
+
+
+def tokenize_batch(texts, model="text-davinci-003"):
+    """Tokenize several texts at once, using tiktoken's multithreaded batch
+    encoding"""
+    return get_tokenizer(model).encode_batch(texts)
 
 
 def detokenize(tokens, model="text-davinci-003"):
-    return tiktoken.encoding_for_model(model).decode(tokens)
+    return get_tokenizer(model).decode(tokens)
 
 
 def french_date_from_timestamp(ts):
-    locale.setlocale(locale.LC_TIME, 'fr_FR.UTF-8')
-    utc_date = datetime.utcfromtimestamp(ts)
-    return utc_date.strftime('%A %d %B %Y')
+    utc_date = datetime.fromtimestamp(ts, tz=timezone.utc)
+    return format_date(utc_date, format='EEEE dd MMMM y', locale='fr_FR')
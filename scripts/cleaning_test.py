@@ -16,7 +16,7 @@ def show_outputs(gmail_client, message_ids, query):
                 for message_id in message_ids]
     # get the raw text
     chunks = retriever.Retriever(test_email, "chunks1k")._cut_messages(messages)
-    query_vector = utils.embed(query)
+    query_vector = utils.embed_query(query)
     # sort by similarity
     chunks = sorted(chunks, key=lambda x: cosine_similarity(query_vector, x[1]), reverse=True)
     for _, v, m in chunks:
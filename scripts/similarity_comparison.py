@@ -2,6 +2,8 @@
 # - the amazon one, that should be very similar (contains the exact text)
 # - one regarding "Passage VMC" that should be less similar
 
+import numpy as np
+
 from bip import utils
 from bip.email.retriever import Retriever
 from bip.config import test_email, retriever_namespace
@@ -14,32 +16,31 @@ copbruyants_chunk_id = '187933238ec01bee-4'
 def similarity_comparison(chunk_id1, chunk_id2):
     # fetch the vectors from pinecone
     retriever = Retriever(test_email, retriever_namespace)
-    amazon_vector = retriever._index.fetch([chunk_id1], retriever_namespace)['vectors'][chunk_id1]['values']
-    vmc_vector = retriever._index.fetch([chunk_id2], retriever_namespace)['vectors'][chunk_id2]['values']
+    vectors = retriever._index.fetch([chunk_id1, chunk_id2], retriever_namespace)['vectors']
+    amazon_vector = np.asarray(vectors[chunk_id1]['values'], dtype=np.float32)
+    vmc_vector = np.asarray(vectors[chunk_id2]['values'], dtype=np.float32)
 
-    print(retriever._index.fetch([chunk_id1], retriever_namespace)['vectors'][chunk_id1]['metadata']['text'])
+    print(vectors[chunk_id1]['metadata']['text'])
     # get the query vector
-    query_vector = utils.embed("voisins silencieux")[0]
+    query_vector = np.asarray(utils.embed_query("voisins silencieux"), dtype=np.float32)
 
-    # compute cosine similarity
-    from numpy import dot
-    from numpy.linalg import norm
-    def cosine_similarity(a, b):
-        return dot(a, b)/(norm(a)*norm(b))
+    # compute cosine similarity, dot product and euclidean distance for both
+    # emails at once
+    emails_matrix = np.stack([amazon_vector, vmc_vector])
+    dots = emails_matrix @ query_vector
+    cosine_similarities = dots / (np.linalg.norm(emails_matrix, axis=1) * np.linalg.norm(query_vector))
+    euclidean_distances = np.linalg.norm(emails_matrix - query_vector, axis=1)
 
-    print("Cosine similarity with amazon email:", cosine_similarity(query_vector, amazon_vector))
-    print("Cosine similarity with vmc email:", cosine_similarity(query_vector, vmc_vector))
+    print("Cosine similarity with amazon email:", cosine_similarities[0])
+    print("Cosine similarity with vmc email:", cosine_similarities[1])
 
     # also print dot product to see the difference
-    print("Dot product with amazon email:", dot(query_vector, amazon_vector))
-    print("Dot product with vmc email:", dot(query_vector, vmc_vector))
+    print("Dot product with amazon email:", dots[0])
+    print("Dot product with vmc email:", dots[1])
 
     # and euclidean distance
-    def euclidean_distance(a, b):
-        return norm(list(map(lambda x: x[0]-x[1], zip(a, b))))
-
-    print("Euclidean distance with amazon email:", euclidean_distance(query_vector, amazon_vector))
-    print("Euclidean distance with vmc email:", euclidean_distance(query_vector, vmc_vector))
+    print("Euclidean distance with amazon email:", euclidean_distances[0])
+    print("Euclidean distance with vmc email:", euclidean_distances[1])
 
 
 similarity_comparison(amazon_chunk_id, vmc_chunk_id)
@@ -65,3 +65,51 @@ mock_gmail_message = {
         }
     }
 }
+
+
+def _encode(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+
+# Nested multipart payload with an empty body and attachments, whose text is
+# multipart_text
+mock_multipart_payload = {
+    "mimeType": "multipart/mixed",
+    "body": {"size": 0},
+    "parts": [
+        {
+            "mimeType": "multipart/alternative",
+            "body": {"size": 0},
+            "parts": [
+                {
+                    "mimeType": "text/plain",
+                    "body": {"size": 11, "data": _encode("First part\n")}
+                },
+                {
+                    "mimeType": "text/html",
+                    "body": {"size": 44, "data": _encode(
+                        '<p>Second <b>part</b> <a href="https://x.y">'
+                        'link</a><img src="a.png"></p>')}
+                }
+            ]
+        },
+        {
+            "mimeType": "text/plain",
+            "body": {"size": 0}
+        },
+        {
+            "mimeType": "application/pdf",
+            "body": {"size": 4, "data": base64.urlsafe_b64encode(
+                b"\xff\xfe\x00\x01").decode('ascii')}
+        },
+        {
+            "mimeType": "image/png",
+            "body": {"size": 10, "attachmentId": "image-attachment"}
+        },
+        {
+            "mimeType": "text/plain",
+            "body": {"size": 10, "data": _encode("Last part\n")}
+        }
+    ]
+}
+multipart_text = "First part\nSecond **part** link\n\nLast part\n"
@@ -0,0 +1,178 @@
+# Test gmail retrieval with a fake gmail API client
+import base64
+import unittest
+from unittest import mock
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from bip.email import gmail
+
+from mock_gmail_message import mock_multipart_payload, multipart_text
+
+
+def rate_limit_error():
+    return HttpError(httplib2.Response({'status': 429}),
+                     b'rateLimitExceeded')
+
+
+def not_found_error():
+    return HttpError(httplib2.Response({'status': 404}), b'notFound')
+
+
+def bad_request_error():
+    return HttpError(httplib2.Response({'status': 400}), b'badRequest')
+
+
+class FakeRequest(object):
+    def __init__(self, result):
+        self._result = result
+
+    def execute(self, http=None):
+        if isinstance(self._result, Exception):
+            raise self._result
+        return self._result
+
+
+class FakeBatch(object):
+    def __init__(self, callback):
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, request_id=None):
+        self._requests.append((request_id, request))
+
+    def execute(self):
+        assert len(self._requests) <= gmail.BATCH_GET_SIZE
+        for request_id, request in self._requests:
+            try:
+                self._callback(request_id, request.execute(), None)
+            except HttpError as error:
+                self._callback(request_id, None, error)
+
+
+class FakeGmailClient(object):
+    """Fake client listing `message_count` messages in pages of `page_size`,
+    where a get of message id fails for the first `failures[id]` times, and
+    always fails with `errors[id]` if given"""
+
+    def __init__(self, message_count, page_size=70, failures=None,
+                 errors=None):
+        self._message_count = message_count
+        self._page_size = page_size
+        self.failures = dict(failures or {})
+        self.errors = dict(errors or {})
+        self.get_counts = {}
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(callback)
+
+    def list(self, userId, q, pageToken=None):
+        page = int(pageToken or 0)
+        start = page * self._page_size
+        end = min(self._message_count, start + self._page_size)
+        response = {}
+        if end > start:
+            response['messages'] = [{'id': str(i)} for i in range(start, end)]
+        if end < self._message_count:
+            response['nextPageToken'] = str(page + 1)
+        return FakeRequest(response)
+
+    def get(self, userId, id, fields=None):
+        self.get_counts[id] = self.get_counts.get(id, 0) + 1
+        if id in self.errors:
+            return FakeRequest(self.errors[id]())
+        if self.failures.get(id, 0) > 0:
+            self.failures[id] -= 1
+            return FakeRequest(rate_limit_error())
+        return FakeRequest({'id': id})
+
+
+@mock.patch.object(gmail, '_thread_http', mock.Mock())
+@mock.patch.object(gmail.time, 'sleep', mock.Mock())
+class TestGmail(unittest.TestCase):
+
+    def test_batch_get_messages(self):
+        client = FakeGmailClient(120)
+        heads = [{'id': str(i)} for i in range(120)]
+        messages = gmail._batch_get_messages(client, heads)
+        self.assertEqual([m['id'] for m in messages],
+                         [str(i) for i in range(120)])
+
+    def test_batch_get_messages_retries_failures(self):
+        client = FakeGmailClient(60, failures={'3': 2, '55': 1})
+        heads = [{'id': str(i)} for i in range(60)]
+        messages = gmail._batch_get_messages(client, heads)
+        self.assertEqual([m['id'] for m in messages],
+                         [str(i) for i in range(60)])
+
+    def test_batch_get_messages_raises_on_persistent_failures(self):
+        client = FakeGmailClient(
+            10, failures={str(i): gmail.BATCH_GET_RETRIES + 1
+                          for i in range(10)})
+        heads = [{'id': str(i)} for i in range(10)]
+        with self.assertRaises(HttpError):
+            gmail._batch_get_messages(client, heads)
+
+    def test_batch_get_messages_skips_missing_messages(self):
+        client = FakeGmailClient(10, failures={'2': 1},
+                                 errors={'5': not_found_error})
+        heads = [{'id': str(i)} for i in range(10)]
+        messages = gmail._batch_get_messages(client, heads)
+        self.assertEqual([m['id'] for m in messages],
+                         [str(i) for i in range(10) if i != 5])
+        # the missing message is not retried, unlike the rate limited one
+        self.assertEqual(client.get_counts['5'], 1)
+        self.assertEqual(client.get_counts['2'], 2)
+
+    def test_batch_get_messages_raises_permanent_errors(self):
+        client = FakeGmailClient(10, errors={'5': bad_request_error})
+        heads = [{'id': str(i)} for i in range(10)]
+        with self.assertRaises(HttpError):
+            gmail._batch_get_messages(client, heads)
+        self.assertEqual(client.get_counts['5'], 1)
+
+    def test_email_batches_by_query(self):
+        client = FakeGmailClient(200, failures={'13': 1})
+        batches = list(gmail.email_batches_by_query(client, None, 'q', 30))
+        self.assertTrue(all(batches))
+        self.assertEqual([m['id'] for batch in batches for m in batch],
+                         [str(i) for i in range(200)])
+
+    def test_email_batches_by_query_without_messages(self):
+        client = FakeGmailClient(0)
+        batches = list(gmail.email_batches_by_query(client, None, 'q'))
+        self.assertEqual(batches, [])
+
+    def test_email_batches_by_query_without_found_messages(self):
+        client = FakeGmailClient(
+            3, errors={str(i): not_found_error for i in range(3)})
+        batches = list(gmail.email_batches_by_query(client, None, 'q'))
+        self.assertEqual(batches, [])
+
+    def test_message_text_from_payload(self):
+        self.assertEqual(
+            gmail.get_message_text_from_payload(mock_multipart_payload),
+            multipart_text)
+
+    def test_message_text_after_unclosed_html(self):
+        def html_payload(html):
+            data = base64.urlsafe_b64encode(html.encode('utf-8'))
+            return {"mimeType": "text/html",
+                    "body": {"size": len(html), "data": data.decode('ascii')}}
+        gmail.get_message_text_from_payload(
+            html_payload('<html><head><style>p{color:red}'))
+        self.assertEqual(
+            gmail.get_message_text_from_payload(
+                html_payload('<p>Rendez-vous demain</p>')),
+            'Rendez-vous demain\n\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
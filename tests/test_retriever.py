@@ -1,9 +1,13 @@
+import copy
 import datetime
 import unittest
+from unittest import mock
 
 from bip.email import retriever
 from bip.config import test_email
 
+from mock_gmail_message import mock_gmail_message
+
 
 class MyTestCase(unittest.TestCase):
     def retrieve_emails(self, test_retriever):
@@ -47,5 +51,80 @@ class MyTestCase(unittest.TestCase):
             'De nouveaux biens de prestige pour votre recherche')
 
 
+
+class FakeIndex(object):
+    """Fake pinecone index storing upserted vectors by id"""
+
+    def __init__(self):
+        self.vectors = {}
+        self.upserted_ids = []
+
+    def fetch(self, ids, namespace=None):
+        return {'vectors': {i: self.vectors[i]
+                            for i in ids if i in self.vectors}}
+
+    def upsert(self, vectors, namespace=None):
+        for vector in vectors:
+            self.vectors[vector[0]] = vector
+            self.upserted_ids.append(vector[0])
+
+
+def fake_embed(texts):
+    return [[1.0, 0.0] for _ in texts]
+
+
+def mock_message(message_id, with_text=True):
+    message = copy.deepcopy(mock_gmail_message)
+    message['id'] = message_id
+    if not with_text:
+        message['payload']['body'] = {'size': 0}
+    return message
+
+
+@mock.patch.object(retriever, 'embed', fake_embed)
+class TestRetrieverStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.retriever = retriever.Retriever.__new__(retriever.Retriever)
+        self.retriever._namespace = 'test'
+        self.retriever._index = FakeIndex()
+        self.retriever._gmail_client = self.retriever._gmail_creds = None
+
+    def update_email_index(self, email_batch):
+        with mock.patch.object(retriever.gmail, 'email_batches_by_dates',
+                               return_value=iter([email_batch])):
+            self.retriever.update_email_index(None, None)
+
+    def test_stored_message_ids(self):
+        self.retriever._index.vectors = {'a-0': None, 'b-1': None}
+        self.assertEqual(
+            self.retriever._stored_message_ids(
+                [mock_message('a'), mock_message('b'), mock_message('c')]),
+            {'a'})
+
+    def test_first_chunk_stored_last(self):
+        self.update_email_index([mock_message('a'), mock_message('b')])
+        for message_id in ('a', 'b'):
+            message_ids = [i for i in self.retriever._index.upserted_ids
+                           if i.startswith(f"{message_id}-")]
+            self.assertGreater(len(message_ids), 1)
+            self.assertEqual(message_ids[-1], f"{message_id}-0")
+
+    def test_update_skips_stored_messages(self):
+        self.update_email_index([mock_message('a')])
+        index = self.retriever._index
+        index.upserted_ids = []
+        self.update_email_index([mock_message('a'), mock_message('b')])
+        self.assertTrue(index.upserted_ids)
+        self.assertTrue(all(i.startswith('b-') for i in index.upserted_ids))
+
+    def test_update_skips_messages_without_text(self):
+        email_batch = [mock_message('a'), mock_message('empty', False)]
+        self.update_email_index(email_batch)
+        with mock.patch.object(self.retriever, '_store_email_batch') as store:
+            self.update_email_index(email_batch)
+            store.assert_not_called()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,18 @@
+# Test utils
+import unittest
+
+from bip import utils
+
+
+class TestUtils(unittest.TestCase):
+
+    def test_french_date_from_timestamp(self):
+        self.assertEqual(utils.french_date_from_timestamp(0),
+                         'jeudi 01 janvier 1970')
+        # dates are in UTC, whatever the local timezone
+        self.assertEqual(utils.french_date_from_timestamp(1680479999),
+                         'dimanche 02 avril 2023')
+
+
+if __name__ == '__main__':
+    unittest.main()